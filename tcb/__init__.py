@@ -1,2 +1,2 @@
 # from tcb.tcb import *
-from .restrictions import same_16_subnet, FamilyChecker, build_family_map
+from .restrictions import same_16_subnet, SubnetChecker, FamilyChecker, FusedChecker, build_family_map, build_member_index, attach_subnets, attach_families
@@ -1,33 +1,121 @@
 from pprint import pprint
+import socket
+import numpy as np
+
+
+def pack_subnet(address):
+    """Pack the first two octets of an IPv4 address into one int."""
+    return int.from_bytes(socket.inet_aton(address), 'big') >> 16
+
+
+def attach_subnets(relays):
+    """Precompute the /16 subnet key for every relay.
+
+    The key is stored as `relay._sub16` so that subnet restrictions only
+    have to compare precomputed ints instead of re-splitting the address
+    strings for every circuit.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes.
+
+    Returns
+    -------
+    None
+
+    """
+    for relay in relays:
+        relay._sub16 = pack_subnet(relay.address)
+
+
+def subnet_array(relays):
+    """Collect the precomputed subnet keys of a relay pool in one array.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes (with `_sub16` attached).
+
+    Returns
+    -------
+    numpy.ndarray
+        uint32 array of /16 subnet keys, parallel to `relays`.
+
+    """
+    return np.fromiter((r._sub16 for r in relays), dtype=np.uint32, count=len(relays))
+
+
+class SubnetChecker(object):
+    """Vectorized form of `same_16_subnet` working on relay index arrays."""
+
+    vectorized = True
+
+    def __init__(self, guards, middle, exits):
+        super(SubnetChecker, self).__init__()
+        self.sub16 = {
+            "guards": subnet_array(guards),
+            "middle": subnet_array(middle),
+            "exits": subnet_array(exits),
+        }
+
+    def __call__(self, gi, mi, ei):
+        gs = self.sub16["guards"][gi]
+        ms = self.sub16["middle"][mi]
+        es = self.sub16["exits"][ei]
+        return (gs != ms) & (gs != es) & (ms != es)
+
+
 def same_16_subnet(circuits):
     ret = []
     for circuit in circuits:
         guard, middle, exit = circuit
-        if not(
-            guard.address.split(".", 2) == middle.address.split(".", 2) or
-            guard.address.split(".", 2) == exit.address.split(".", 2) or
-                middle.address.split(".", 2) == exit.address.split(".", 2)):
+        if guard._sub16 != middle._sub16 and\
+                guard._sub16 != exit._sub16 and\
+                middle._sub16 != exit._sub16:
             ret.append(circuit)
         else:
             pass
             # print("samesubnet fired")
     return ret
 
-def get_digest_for_member(ident, consensus):
-    for node in consensus:
-        if (ident == node.nickname or ident == node.fingerprint):
-            return node.microdescriptor_digest()
+def build_member_index(nodes):
+    """Index consensus relays by nickname and fingerprint.
+
+    Family declarations reference members either way, so one dict lookup
+    resolves a member instead of scanning the whole consensus.
+
+    Parameters
+    ----------
+    nodes : list
+        relay entries of the consensus.
 
-def build_family_map(descriptors, consensus):
+    Returns
+    -------
+    dict
+        mapping of nickname and fingerprint to microdescriptor digest.
+
+    """
+    index = {}
+    for node in nodes:
+        index[node.nickname] = node.microdescriptor_digest
+        index[node.fingerprint] = node.microdescriptor_digest
+    return index
+
+
+def get_digest_for_member(ident, member_index):
+    return member_index.get(ident)
+
+def build_family_map(descriptors, member_index):
     family_map = {}
     family_counter = 0
     for desc in descriptors:
         if desc.family:
             digest = desc.digest()
-            if digest not in family_map.keys():
+            if digest not in family_map:
                 family_map[digest] = family_counter
                 for member in desc.family:
-                    member_digest = get_digest_for_member(member, consensus)
+                    member_digest = get_digest_for_member(member, member_index)
                     if member_digest:
                         family_map[member_digest] = family_counter
                     else:
@@ -36,19 +124,73 @@ def build_family_map(descriptors, consensus):
     return family_map
 
 
+def attach_families(relays, family_map):
+    """Precompute the family id for every relay.
+
+    The id is stored as `relay._fam_id`, with `-1` meaning "no family",
+    so family checks compare two ints instead of probing the family map.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes.
+    family_map : dict
+        mapping of microdescriptor digest to family id.
+
+    Returns
+    -------
+    None
+
+    """
+    for relay in relays:
+        relay._fam_id = family_map.get(relay.microdescriptor_digest, -1)
+
+
+def family_array(relays):
+    """Collect the precomputed family ids of a relay pool in one array.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes (with `_fam_id` attached).
+
+    Returns
+    -------
+    numpy.ndarray
+        int32 array of family ids, parallel to `relays`.
+
+    """
+    return np.fromiter((r._fam_id for r in relays), dtype=np.int32, count=len(relays))
+
+
 class FamilyChecker(object):
     """docstring for FamilyChecker."""
 
-    def __init__(self, family_map):
+    def __init__(self, family_map, guards=None, middle=None, exits=None):
         super(FamilyChecker, self).__init__()
         self.family_map = family_map
+        self.vectorized = guards is not None
+        if self.vectorized:
+            self.family = {
+                "guards": family_array(guards),
+                "middle": family_array(middle),
+                "exits": family_array(exits),
+            }
 
     def same_family(self, node_a, node_b):
-        return node_a.microdescriptor_digest in self.family_map.keys() and\
-            node_b.microdescriptor_digest in self.family_map.keys() and\
-            self.family_map[node_b.microdescriptor_digest] == self.family_map[node_a.microdescriptor_digest]
+        return node_a._fam_id != -1 and node_a._fam_id == node_b._fam_id
+
+    def __call__(self, circuits, mi=None, ei=None):
+        if mi is None:
+            return self._check_circuits(circuits)
+        fg = self.family["guards"][circuits]
+        fm = self.family["middle"][mi]
+        fe = self.family["exits"][ei]
+        return ~(((fg == fm) & (fg != -1)) |
+                 ((fm == fe) & (fm != -1)) |
+                 ((fg == fe) & (fg != -1)))
 
-    def __call__(self, circuits):
+    def _check_circuits(self, circuits):
         out = []
         for circuit in circuits:
             guard, middle, exit = circuit
@@ -59,3 +201,39 @@ class FamilyChecker(object):
             else:
                 pass
         return out
+
+
+class FusedChecker(object):
+    """Subnet and family restriction fused into a single masking pass.
+
+    Holds the per-pool subnet key and family id arrays and evaluates both
+    checks in one boolean expression, so a batch of sampled circuits is
+    traversed once instead of once per restriction.
+    """
+
+    vectorized = True
+
+    def __init__(self, guards, middle, exits):
+        super(FusedChecker, self).__init__()
+        self.sub16 = {
+            "guards": subnet_array(guards),
+            "middle": subnet_array(middle),
+            "exits": subnet_array(exits),
+        }
+        self.family = {
+            "guards": family_array(guards),
+            "middle": family_array(middle),
+            "exits": family_array(exits),
+        }
+
+    def __call__(self, gi, mi, ei):
+        gs = self.sub16["guards"][gi]
+        ms = self.sub16["middle"][mi]
+        es = self.sub16["exits"][ei]
+        fg = self.family["guards"][gi]
+        fm = self.family["middle"][mi]
+        fe = self.family["exits"][ei]
+        return (gs != ms) & (gs != es) & (ms != es) &\
+            ~(((fg == fm) & (fg != -1)) |
+              ((fm == fe) & (fm != -1)) |
+              ((fg == fe) & (fg != -1)))
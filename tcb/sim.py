@@ -1,17 +1,126 @@
 """Tor Snapshot Simulator."""
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from stem import Flag
 from stem.descriptor import parse_file
 import logging
-from numpy.random import choice
-from numpy import array
-# from . import restrictions
-#from restrictions import same_16_subnet, FamilyChecker, build_family_map
+import numpy as np
+from tcb.restrictions import SubnetChecker, FamilyChecker, FusedChecker, build_family_map, build_member_index, attach_subnets, attach_families
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the NumPy path is used instead
+    njit = None
 
 logger = logging.getLogger()
 # logger.setLevel(logging.DEBUG)
 
+_rng = np.random.default_rng()
+
+
+def seed_rng(seed):
+    """Reseed the module random generator for reproducible runs."""
+    global _rng
+    _rng = np.random.default_rng(seed)
+    if _seed_kernel is not None:
+        _seed_kernel(seed)
+
+
+# one bit per consensus flag the simulator cares about
+RUNNING = 1 << 1
+VALID = 1 << 2
+FAST = 1 << 3
+STABLE = 1 << 4
+GUARD = 1 << 5
+EXIT = 1 << 6
+BADEXIT = 1 << 7
+
+FLAG_BITS = ((Flag.RUNNING, RUNNING), (Flag.VALID, VALID), (Flag.FAST, FAST),
+             (Flag.STABLE, STABLE), (Flag.GUARD, GUARD), (Flag.EXIT, EXIT),
+             (Flag.BADEXIT, BADEXIT))
+
+# (required, forbidden) flag bits per circuit position
+POSITION_FLAGS = {
+    "guards": (GUARD | RUNNING | VALID, 0),
+    "middle": (RUNNING | VALID, 0),
+    "exits": (RUNNING | VALID, BADEXIT),
+}
+
+
+def _accepts(flag_mask, position, fast, stable):
+    """Check flag bits against the requirements of a position.
+
+    Works elementwise on a whole flag array just as well as on a single
+    relay's mask.
+    """
+    need, forbid = POSITION_FLAGS[position]
+    need |= (FAST if fast else 0) | (STABLE if stable else 0)
+    return (flag_mask & (need | forbid)) == need
+
+
+def attach_flag_masks(relays):
+    """Precompute a flag bitmask for every relay.
+
+    The mask is stored as `relay._fm` so the filter predicates and
+    bandwidth weighting can test flags with a single bitwise AND instead
+    of repeated set membership tests on `relay.flags`.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes.
+
+    Returns
+    -------
+    None
+
+    """
+    for relay in relays:
+        relay._fm = sum(bit for flag, bit in FLAG_BITS if flag in relay.flags)
+
+
+def flag_array(relays):
+    """Collect the precomputed flag bitmasks of a relay pool in one array.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes (with `_fm` attached).
+
+    Returns
+    -------
+    numpy.ndarray
+        uint32 array of flag bitmasks, parallel to `relays`.
+
+    """
+    return np.fromiter((r._fm for r in relays), dtype=np.uint32, count=len(relays))
+
+
+def eligibility_masks(relays, fast=None, stable=None, flag_arr=None):
+    """Compute guard/middle/exit eligibility for all relays in one sweep.
+
+    Parameters
+    ----------
+    relays : list
+        list of tor nodes.
+    fast : boolean
+        flag if nodes must have fast flag (the default is None).
+    stable : boolean
+        flag if nodes must have stable flag (the default is None).
+    flag_arr : numpy.ndarray
+        flag bitmask array to reuse (the default is None, which builds it
+        from `relays`).
+
+    Returns
+    -------
+    dict
+        boolean eligibility mask per position, parallel to `relays`.
+
+    """
+    if flag_arr is None:
+        flag_arr = flag_array(relays)
+    return {pos: _accepts(flag_arr, pos, fast, stable) for pos in POSITION_FLAGS}
+
 
 def filter_exits(relays, fast=None, stable=None):
     """Filter tor nodes for exits .
@@ -31,7 +140,8 @@ def filter_exits(relays, fast=None, stable=None):
         potential exits.
 
     """
-    ret = [x for x in relays if can_exit(x, fast, stable)]
+    mask = eligibility_masks(relays, fast, stable)["exits"]
+    ret = [relays[i] for i in np.nonzero(mask)[0]]
     logger.debug(f"#{len(ret)} exit nodes found")
     return ret
 
@@ -54,7 +164,8 @@ def filter_middle(relays, fast=None, stable=None):
         potential middle nodes.
 
     """
-    ret = [x for x in relays if can_middle(x, fast, stable)]
+    mask = eligibility_masks(relays, fast, stable)["middle"]
+    ret = [relays[i] for i in np.nonzero(mask)[0]]
     logger.debug(f"#{len(ret)} middle nodes found")
     return ret
 
@@ -77,7 +188,8 @@ def filter_guards(relays, fast=None, stable=None):
         potential guards.
 
     """
-    ret = [x for x in relays if can_guard(x, fast, stable)]
+    mask = eligibility_masks(relays, fast, stable)["guards"]
+    ret = [relays[i] for i in np.nonzero(mask)[0]]
     logger.debug(f"#{len(ret)} guard nodes found")
     return ret
 
@@ -100,11 +212,7 @@ def can_exit(relay, fast, stable):
         flag if relay can function as an exit .
 
     """
-    return Flag.BADEXIT not in relay.flags and\
-        Flag.RUNNING in relay.flags and\
-        Flag.VALID in relay.flags and\
-        ((not fast) or Flag.FAST in relay.flags) and\
-        ((not stable) or Flag.STABLE in relay.flags)
+    return _accepts(relay._fm, "exits", fast, stable)
 
 
 def can_middle(relay, fast, stable):
@@ -125,11 +233,7 @@ def can_middle(relay, fast, stable):
         flag if relay can function as a middle relay.
 
     """
-    return \
-        Flag.RUNNING in relay.flags and\
-        Flag.VALID in relay.flags and\
-        ((not fast) or Flag.FAST in relay.flags) and\
-        ((not stable) or Flag.STABLE in relay.flags)
+    return _accepts(relay._fm, "middle", fast, stable)
 
 
 def can_guard(relay, fast, stable):
@@ -150,12 +254,7 @@ def can_guard(relay, fast, stable):
         flag if relay can function as a guard
 
     """
-    return \
-        Flag.GUARD in relay.flags and\
-        Flag.RUNNING in relay.flags and\
-        Flag.VALID in relay.flags and\
-        ((not fast) or Flag.FAST in relay.flags) and\
-        ((not stable) or Flag.STABLE in relay.flags)
+    return _accepts(relay._fm, "guards", fast, stable)
 
 def print_num_circuit(circuits):
     print(len(circuits))
@@ -179,6 +278,95 @@ def print_circuit(circuits):
         print(f"{guard.address} {middle.address} {exit.address}")
 
 
+if njit is not None:
+    @njit(cache=True)
+    def _sample_batch(n, cum_g, cum_m, cum_e, sub_g, sub_m, sub_e, fam_g, fam_m, fam_e):
+        """Sample n circuits and filter subnet/family clashes in one loop."""
+        gi = np.empty(n, dtype=np.int64)
+        mi = np.empty(n, dtype=np.int64)
+        ei = np.empty(n, dtype=np.int64)
+        kept = 0
+        for _ in range(n):
+            g = min(np.searchsorted(cum_g, np.random.random(), side='right'), len(cum_g) - 1)
+            m = min(np.searchsorted(cum_m, np.random.random(), side='right'), len(cum_m) - 1)
+            e = min(np.searchsorted(cum_e, np.random.random(), side='right'), len(cum_e) - 1)
+            if sub_g[g] == sub_m[m] or sub_g[g] == sub_e[e] or sub_m[m] == sub_e[e]:
+                continue
+            fg = fam_g[g]
+            fm = fam_m[m]
+            fe = fam_e[e]
+            if (fg != -1 and fg == fm) or (fm != -1 and fm == fe) or (fg != -1 and fg == fe):
+                continue
+            gi[kept] = g
+            mi[kept] = m
+            ei[kept] = e
+            kept += 1
+        return gi[:kept], mi[:kept], ei[:kept]
+    @njit(cache=True)
+    def _seed_kernel(seed):
+        np.random.seed(seed)
+else:
+    _sample_batch = None
+    _seed_kernel = None
+
+
+def _sample_indices(cum, n):
+    """Draw n relay indices from a cumulative weight distribution."""
+    return np.minimum(np.searchsorted(cum, _rng.random(n), side='right'), len(cum) - 1)
+
+
+def resolve_fixed_relay(ident, relays):
+    """Resolve a fixed order position to an index into the relay pool.
+
+    Parameters
+    ----------
+    ident : str
+        ip address (as documented in order.readme), nickname or
+        fingerprint from the order line.
+    relays : list
+        eligible relays for the position.
+
+    Returns
+    -------
+    int
+        index of the relay in `relays`.
+
+    """
+    for i, relay in enumerate(relays):
+        if ident == relay.address or\
+                ident == relay.nickname or\
+                ident == relay.fingerprint:
+            return i
+    raise ValueError(f"relay {ident} is not in the eligible pool")
+
+
+def _draw(cum, fixed_idx, position, n):
+    """Produce n relay indices for a position, sampled or broadcast."""
+    idx = fixed_idx[position]
+    if idx is not None:
+        return np.full(n, idx, dtype=np.int64)
+    return _sample_indices(cum[position], n)
+
+
+def _kernel_checkers(restrictions):
+    """Return the (subnet, family) checkers if the Numba kernel covers them.
+
+    The kernel fuses exactly the subnet and family restrictions; any other
+    combination of vectorized restrictions falls back to the NumPy path.
+    """
+    vectorized = [r for r in restrictions or [] if getattr(r, "vectorized", False)]
+    if len(vectorized) == 1 and isinstance(vectorized[0], FusedChecker):
+        # carries both the sub16 and family arrays itself
+        return vectorized[0], vectorized[0]
+    if len(vectorized) != 2:
+        return None
+    subnet = next((r for r in vectorized if isinstance(r, SubnetChecker)), None)
+    family = next((r for r in vectorized if isinstance(r, FamilyChecker)), None)
+    if subnet is None or family is None:
+        return None
+    return subnet, family
+
+
 def create_circuits(order, guards, middle, exits, weights, restrictions=None, callbacks=None):
     """Create circuits.
 
@@ -197,6 +385,9 @@ def create_circuits(order, guards, middle, exits, weights, restrictions=None, ca
         # TODO ugly design. Should redo this.
     restrictions : list
         list of callables to filter circuits (should return something) (the default is None).
+        Vectorized restrictions (marked with `vectorized = True`) get the
+        sampled index arrays and return a boolean mask; plain restrictions
+        get the zipped circuit list as before.
     callbacks : list
         list of callables to do something with the created circuits (the default is None).
 
@@ -207,70 +398,99 @@ def create_circuits(order, guards, middle, exits, weights, restrictions=None, ca
     """
     created = 0
     number = order["number"]
+    vectorized = [r for r in restrictions or [] if getattr(r, "vectorized", False)]
+    plain = [r for r in restrictions or [] if not getattr(r, "vectorized", False)]
+    cum = {pos: np.cumsum(weights[pos])
+           for pos, fixed in (("guards", order["guard"]),
+                              ("middle", order["middle"]),
+                              ("exits", order["exit"]))
+           if not fixed}
+    # pinned positions are resolved to a pool index once and broadcast,
+    # so the restriction code sees uniform index arrays either way
+    fixed_idx = {
+        "guards": resolve_fixed_relay(order["guard"], guards) if order["guard"] else None,
+        "middle": resolve_fixed_relay(order["middle"], middle) if order["middle"] else None,
+        "exits": resolve_fixed_relay(order["exit"], exits) if order["exit"] else None,
+    }
+    checkers = None
+    if _sample_batch is not None and\
+            not (order["guard"] or order["middle"] or order["exit"]):
+        checkers = _kernel_checkers(restrictions)
+    if checkers is not None:
+        subnet, family = checkers
+        while created < number:
+            gi, mi, ei = _sample_batch(
+                number - created,
+                cum["guards"], cum["middle"], cum["exits"],
+                subnet.sub16["guards"], subnet.sub16["middle"], subnet.sub16["exits"],
+                family.family["guards"], family.family["middle"], family.family["exits"])
+            circuits = [(guards[g], middle[m], exits[e])
+                        for g, m, e in zip(gi, mi, ei)]
+            for restriction in plain:
+                circuits = restriction(circuits)
+            if callbacks:
+                for cb in callbacks:
+                    cb(circuits)
+            created += len(circuits)
+            logger.debug(f"{len(circuits)} circuits created")
+        return
     while created < number:
-        if not order["exit"]:
-            exit_cand = choice(exits, number-created, p=weights["exits"])
-        else:
-            exit_cand = order["exit"]
-        if not order["middle"]:
-            middle_cand = choice(middle, number-created, p=weights["middle"])
-        else:
-            middle_cand = order["middle"]
-        if not order["guard"]:
-            guard_cand = choice(guards, number-created, p=weights["guards"])
-        else:
-            guard_cand = order["guard"]
-        circuits = list(zip(guard_cand, middle_cand, exit_cand))
-        if restrictions:
-            for restriction in restrictions:
+        missing = number - created
+        exit_idx = _draw(cum, fixed_idx, "exits", missing)
+        middle_idx = _draw(cum, fixed_idx, "middle", missing)
+        guard_idx = _draw(cum, fixed_idx, "guards", missing)
+        keep = None
+        for restriction in vectorized:
+            mask = restriction(guard_idx, middle_idx, exit_idx)
+            keep = mask if keep is None else keep & mask
+        if keep is not None:
+            guard_idx = guard_idx[keep]
+            middle_idx = middle_idx[keep]
+            exit_idx = exit_idx[keep]
+        if plain or callbacks:
+            # relay tuples are only built when something consumes them
+            circuits = [(guards[g], middle[m], exits[e])
+                        for g, m, e in zip(guard_idx, middle_idx, exit_idx)]
+            for restriction in plain:
                 circuits = restriction(circuits)
-        if callbacks:
-            for cb in callbacks:
-                cb(circuits)
-        created += len(circuits)
-        logger.debug(f"{len(circuits)} circuits created")
+            if callbacks:
+                for cb in callbacks:
+                    cb(circuits)
+            kept = len(circuits)
+        else:
+            kept = len(guard_idx)
+        created += kept
+        logger.debug(f"{kept} circuits created")
+
 
+# consensus weight keys per position, indexed by the GUARD/EXIT bits of
+# the relay's flag mask: 0 = neither, 1 = guard, 2 = exit, 3 = both
+BW_WEIGHT_KEYS = {
+    'guard': ('Wgm', 'Wgg', None, 'Wgd'),
+    'middle': ('Wmm', 'Wmg', 'Wme', 'Wmd'),
+    'exit': ('Wem', 'Weg', 'Wee', 'Wed'),
+}
 
-def get_bw_weight(flags, position, bw_weights):
+
+def get_bw_weight(flag_mask, position, bw_weights):
     """Return weight to apply to relay's bandwidth for given position.
 
-        flags: list of Flag values for relay from a consensus
+        flag_mask: precomputed flag bitmask of the relay (attach_flag_masks)
         position: position for which to find selection weight,
-             one of 'g' for guard, 'm' for middle, and 'e' for exit
+             one of 'guard', 'middle' and 'exit'
         bw_weights: bandwidth_weights from NetworkStatusDocumentV3 consensus
 
-        straight copy from torps
+        adapted from torps
     """
-    if (position == 'guard'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wgd']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Wgg']
-        elif (Flag.EXIT not in flags):
-            return bw_weights['Wgm']
-        else:
-            raise ValueError('Wge weight does not exist.')
-    elif (position == 'middle'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wmd']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Wmg']
-        elif (Flag.EXIT in flags):
-            return bw_weights['Wme']
-        else:
-            return bw_weights['Wmm']
-    elif (position == 'exit'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wed']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Weg']
-        elif (Flag.EXIT in flags):
-            return bw_weights['Wee']
-        else:
-            return bw_weights['Wem']
-    else:
+    try:
+        keys = BW_WEIGHT_KEYS[position]
+    except KeyError:
         raise ValueError('get_weight does not support position {0}.'.format(
             position))
+    key = keys[(flag_mask >> 5) & 3]
+    if key is None:
+        raise ValueError('Wge weight does not exist.')
+    return bw_weights[key]
 
 
 def assign_weights_by_roles(relays, scale, position, weights):
@@ -289,18 +509,49 @@ def assign_weights_by_roles(relays, scale, position, weights):
 
     Returns
     -------
-    type
-        Description of returned object.
+    numpy.ndarray
+        unnormalized selection weight per relay.
 
-    Almost straight copy from torps.
+    Table-driven variant of the torps original.
 
     """
-    out = []
-    for relay in relays:
-        weight = get_bw_weight(relay.flags, position, weights)/scale
-        bw = float(relay.bandwidth)
-        out.append(bw*weight)
-    return out
+    try:
+        keys = BW_WEIGHT_KEYS[position]
+    except KeyError:
+        raise ValueError('get_weight does not support position {0}.'.format(
+            position))
+    guard_exit = (flag_array(relays) >> 5) & 3
+    if None in keys and (guard_exit == keys.index(None)).any():
+        raise ValueError('Wge weight does not exist.')
+    table = np.array([weights[key] if key is not None else 0.0 for key in keys],
+                     dtype=np.float64)/scale
+    bw_arr = np.fromiter((float(r.bandwidth) for r in relays),
+                         dtype=np.float64, count=len(relays))
+    return bw_arr*table[guard_exit]
+
+
+def load_microdesc(digest, microdesc_dir):
+    """Load the microdescriptor of a single relay.
+
+    Parameters
+    ----------
+    digest : str
+        lowercased microdescriptor digest of the relay.
+    microdesc_dir : path
+        path to folder of microdescriptors.
+
+    Returns
+    -------
+    tuple
+        (digest, microdescriptor document) pair; the document is None if
+        the file holds no document.
+
+    """
+    microdesc_path = os.path.join(microdesc_dir, digest[0], digest[1], digest)
+    microdesc = parse_file(microdesc_path, 'microdescriptor 1.0', document_handler='DOCUMENT')
+    for document in microdesc:
+        return digest, document
+    return digest, None
 
 
 def create_order(line):
@@ -317,38 +568,35 @@ def create_order(line):
         dict of the order information.
 
     """
-    line = line.strip("\n")
-    fields = ["number", "guard", "middle", "exit", "destination", "extra"]
-    order = {i: None for i in fields}
-    splitted = line.split(" ", len(fields))
-    for field, data in zip(fields[:len(splitted)], splitted):
-        order[field] = data
-    order["number"] = int(order["number"])  # TODO catch exception
-    for field in fields[1:4]:
-        if order[field] == "*":
-            order[field] = None
-    return order
-
-
-def can_exit_port(exit, policy, destination):
-    """Check if relay allows exit to destination.
+    parts = line.rstrip("\n").split(" ", 5)
+    parts += [None]*(6-len(parts))
+    number, guard, middle, exit, destination, extra = parts
+    return {
+        "number": int(number),  # TODO catch exception
+        "guard": guard if guard != "*" else None,
+        "middle": middle if middle != "*" else None,
+        "exit": exit if exit != "*" else None,
+        "destination": destination,
+        "extra": extra,
+    }
+
+
+def scan_exit_policy(policy, port):
+    """Scan exit policy rules for a port decision.
 
     Parameters
     ----------
-    exit : relay
-        tor relay.
-    destination : str
-        target destionation in form of <ip address>:<port>.
+    policy : exit policy
+        exit policy of a relay.
+    port : int
+        target port.
 
     Returns
     -------
     boolean
-        flag if relay allows exit to destination.
+        flag if the policy accepts the port.
 
     """
-    if not destination:
-        return True
-    port = int(destination.split(":")[1])
     for rule in policy:
         if port >= rule.min_port and port <= rule.max_port:
             if rule.is_address_wildcard() or\
@@ -360,6 +608,59 @@ def can_exit_port(exit, policy, destination):
     return True
 
 
+def compile_port_bitmap(policy):
+    """Compile an exit policy into a 65536-bit port acceptance bitmap.
+
+    The first wildcard rule covering a port decides it, ports no rule
+    covers default to accept -- the same semantics as scan_exit_policy,
+    precomputed for all ports at once.
+
+    Parameters
+    ----------
+    policy : exit policy
+        exit policy of a relay.
+
+    Returns
+    -------
+    numpy.ndarray
+        8 KiB uint8 array with one accept bit per port.
+
+    """
+    accept = np.ones(65536, dtype=bool)
+    decided = np.zeros(65536, dtype=bool)
+    for rule in policy:
+        if rule.is_address_wildcard() or\
+                rule.get_masked_bits() == 0:
+            span = slice(rule.min_port, rule.max_port+1)
+            accept[span][~decided[span]] = bool(rule.is_accept)
+            decided[span] = True
+    return np.packbits(accept, bitorder='little')
+
+
+def can_exit_port(exit, bitmap, destination):
+    """Check if relay allows exit to destination.
+
+    Parameters
+    ----------
+    exit : relay
+        tor relay.
+    bitmap : numpy.ndarray
+        port acceptance bitmap of the relay (compile_port_bitmap).
+    destination : str
+        target destionation in form of <ip address>:<port>.
+
+    Returns
+    -------
+    boolean
+        flag if relay allows exit to destination.
+
+    """
+    if not destination:
+        return True
+    port = int(destination.split(":")[1])
+    return bool((bitmap[port >> 3] >> (port & 7)) & 1)
+
+
 def main():
     """Short summary.
 
@@ -377,55 +678,76 @@ def main():
     parser.add_argument("order", help="path to order file")
     parser.add_argument("consensus", help="path to microdesc consensus file")
     parser.add_argument("microdesc_dir", help="path to folder of microdescriptors")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random generator")
     args = parser.parse_args()
+    if args.seed is not None:
+        seed_rng(args.seed)
     try:
         consensus = parse_file(args.consensus, 'network-status-microdesc-consensus-3 1.0', document_handler='DOCUMENT')
     except TypeError:
         print("File {} does not seem to be a valid Tor file")
     for document in consensus:
         nodes = [document.routers[x] for x in document.routers]
-        middle = filter_middle(nodes)
-        guards = filter_guards(nodes)
+        attach_subnets(nodes)
+        attach_flag_masks(nodes)
+        masks = eligibility_masks(nodes)
+        middle = [nodes[i] for i in np.nonzero(masks["middle"])[0]]
+        guards = [nodes[i] for i in np.nonzero(masks["guards"])[0]]
+        base_exits = [nodes[i] for i in np.nonzero(masks["exits"])[0]]
+        logger.debug(f"#{len(guards)} guard nodes found")
+        logger.debug(f"#{len(middle)} middle nodes found")
+        logger.debug(f"#{len(base_exits)} exit nodes found")
         bandwidth_weights = document.bandwidth_weights
         break
 
     weights = {}
-    weights["guards"] = array(assign_weights_by_roles(guards, 10000, "guard", bandwidth_weights))
+    weights["guards"] = assign_weights_by_roles(guards, 10000, "guard", bandwidth_weights)
     weights["guards"] = weights["guards"]/weights["guards"].sum()  # normalize weights
     # weights["middle"] = [1/len(middle) for m in middle]
-    weights["middle"] = array(assign_weights_by_roles(middle, 10000, "middle", bandwidth_weights))
+    weights["middle"] = assign_weights_by_roles(middle, 10000, "middle", bandwidth_weights)
     weights["middle"] = weights["middle"]/weights["middle"].sum()
+    base_exit_bw = assign_weights_by_roles(base_exits, 10000, "exit", bandwidth_weights)
 
     # collect micro descriptors
     # also, remember the exit policy for each node, as it is stored in the microdesc
+    # parsing thousands of tiny files is latency-bound, so overlap the reads
     microdescs = []
-    exit_policies = dict()
-    for node in nodes:
-        digest = node.digest.lower()
-        microdesc_path = os.path.join(args.microdesc_dir, digest[0], digest[1], digest)
-
-        microdesc = parse_file(microdesc_path, 'microdescriptor 1.0', document_handler='DOCUMENT')
-        for document in microdesc:
+    exit_bitmaps = dict()
+    digests = [node.digest.lower() for node in nodes]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = executor.map(load_microdesc, digests, [args.microdesc_dir]*len(digests))
+        for digest, document in results:
+            if document is None:
+                continue
             microdescs.append(document)
-            exit_policies[digest] = document.exit_policy
-            break
+            exit_bitmaps[digest] = compile_port_bitmap(document.exit_policy)
 
-    family_map = build_family_map(microdescs, consensus)
-    same_family = FamilyChecker(family_map)
+    family_map = build_family_map(microdescs, build_member_index(nodes))
+    attach_families(nodes, family_map)
 
+    # one bitmap row per base exit, so a port query is one vectorized bit test
+    exit_port_bits = np.stack([exit_bitmaps[x.digest.lower()] for x in base_exits])
     with open(args.order) as order_file:
         for line in order_file:
             order = create_order(line)
-            exits = filter_exits(nodes)
-            logger.debug(f"len of exits before: {len(exits)}")
-            exits = [x for x in exits if can_exit_port(x, exit_policies[x.digest.lower()], order["destination"])]
+            logger.debug(f"len of exits before: {len(base_exits)}")
+            if order["destination"]:
+                port = int(order["destination"].split(":")[1])
+                port_mask = ((exit_port_bits[:, port >> 3] >> (port & 7)) & 1).astype(bool)
+            else:
+                port_mask = np.ones(len(base_exits), dtype=bool)
+            exits = [base_exits[i] for i in np.nonzero(port_mask)[0]]
             logger.debug(f"len of exits after: {len(exits)}")
             # weights["exits"] = [1/len(exits) for e in exits]
-            weights["exits"] = array(assign_weights_by_roles(exits, 10000, "exit", bandwidth_weights))
-            weights["exits"] = weights["exits"]/weights["exits"].sum()
+            exit_bw = base_exit_bw[port_mask]
+            weights["exits"] = exit_bw/exit_bw.sum()
             logger.debug(order)
             logger.debug(len(exits))
-            create_circuits(order, guards, middle, exits, weights, callbacks=[print_num_circuit], restrictions=[same_16_subnet, same_family])
+            subnet_and_family = FusedChecker(guards, middle, exits)
+            try:
+                create_circuits(order, guards, middle, exits, weights, callbacks=[print_num_circuit], restrictions=[subnet_and_family])
+            except ValueError as err:
+                logger.error(f"skipping order '{line.strip()}': {err}")
 
 
 if __name__ == '__main__':